@@ -2,6 +2,7 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 from odoo import fields, models
 from odoo.tools.safe_eval import safe_eval
+from odoo.tools.sql import create_index
 
 
 class StockLocation(models.Model):
@@ -17,6 +18,17 @@ class StockLocation(models.Model):
         compute="_compute_location_orderpoint_count",
     )
 
+    def init(self):
+        super().init()
+        # child_of domains search the locations with parent_path LIKE 'path%'
+        # which the default index of parent_path cannot be used for
+        create_index(
+            self.env.cr,
+            "stock_location_parent_path_pattern_index",
+            self._table,
+            ["parent_path varchar_pattern_ops"],
+        )
+
     def _compute_location_orderpoint_count(self):
         groups = self.env["stock.location.orderpoint"].read_group(
             [("location_id", "in", self.ids)], ["location_id"], ["location_id"]
@@ -1,14 +1,24 @@
 # Copyright 2023 Michael Tietz (MT Software) <mtietz@mt-software.de>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
-from collections import defaultdict
-from copy import copy
+import logging
+from bisect import bisect_right
+from collections import Counter, defaultdict, namedtuple
 
 from odoo import _, api, fields, models
 from odoo.exceptions import ValidationError
 from odoo.osv import expression
-from odoo.tools import float_compare, split_every
+from odoo.tools import float_round, split_every
 
 from odoo.addons.stock.models.stock_move import PROCUREMENT_PRIORITIES
+from odoo.addons.stock.models.stock_rule import ProcurementException
+
+_logger = logging.getLogger(__name__)
+
+# Quantities of a product on a location, see _compute_quantities_dict
+LocationQuantities = namedtuple(
+    "LocationQuantities",
+    ["virtual_available", "incoming_qty", "outgoing_qty", "free_qty"],
+)
 
 
 class StockLocationOrderpoint(models.Model):
@@ -75,7 +85,7 @@ class StockLocationOrderpoint(models.Model):
         "will be grouped into one big picking.",
     )
     location_src_id = fields.Many2one(
-        "stock.location", compute="_compute_location_src_id", store=True
+        "stock.location", compute="_compute_location_src_id", store=True, index=True
     )
     active = fields.Boolean("Active", default=True)
     priority = fields.Selection(
@@ -112,23 +122,30 @@ class StockLocationOrderpoint(models.Model):
 
     @api.depends("location_id", "route_id")
     def _compute_location_src_id(self):
+        # Load the rules of all the routes at once
+        # as the rules are browsed again when following the route
+        self.route_id.rule_ids.read(
+            ["action", "location_id", "location_src_id", "procure_method"]
+        )
+        locations_src = {}
         for orderpoint in self:
             location = False
             if orderpoint.location_id and orderpoint.route_id:
-                location = orderpoint.location_id._get_source_location_from_route(
-                    orderpoint.route_id,
-                    "make_to_stock",
-                )
+                key = (orderpoint.location_id, orderpoint.route_id)
+                if key not in locations_src:
+                    location_dest, route = key
+                    locations_src[key] = location_dest._get_source_location_from_route(
+                        route, "make_to_stock"
+                    )
+                location = locations_src[key]
             orderpoint.location_src_id = location
 
     def _prepare_procurement(self, product, qty, date_planned, proc_vals):
         self.ensure_one()
-        proc_vals = copy(proc_vals)
-        proc_vals.update(
-            {
-                "date_planned": date_planned or fields.Datetime.now(),
-            }
-        )
+        proc_vals = {
+            **proc_vals,
+            "date_planned": date_planned or fields.Datetime.now(),
+        }
         return self.env["procurement.group"].Procurement(
             product,
             qty,
@@ -140,17 +157,48 @@ class StockLocationOrderpoint(models.Model):
             proc_vals,
         )
 
-    def _prepare_procurement_values(self):
+    def _prepare_procurement_values(self, warehouse=None):
+        """
+        :param warehouse: closest warehouse of the orderpoint's location
+            if already known by the caller
+        """
         self.ensure_one()
+        if warehouse is None:
+            warehouse = self.location_id.get_closest_warehouse()
         return {
             "route_ids": self.route_id,
             "date_deadline": False,
-            "warehouse_id": self.location_id.get_closest_warehouse(),
+            "warehouse_id": warehouse,
             "group_id": self.group_id,
             "priority": self.priority or "0",
             "location_orderpoint_id": self.id,
         }
 
+    def _get_child_location_ids_by_location(self):
+        """
+        Returns the ids of the orderpoints' locations and of all their children
+        per location, the children of all the locations being searched at once
+        """
+        locations = self.location_id
+        if not locations:
+            return {}
+        children = (
+            self.env["stock.location"]
+            .sudo()
+            .with_context(active_test=False)
+            .search([("id", "child_of", locations.ids)])
+        )
+        child_ids_by_location_id = {location.id: [] for location in locations}
+        # Each child is added to the orderpoints' locations among its parents,
+        # the ids of which are the components of its parent_path
+        for child in children:
+            for parent_id in child.parent_path.split("/")[:-1]:
+                if int(parent_id) in child_ids_by_location_id:
+                    child_ids_by_location_id[int(parent_id)].append(child.id)
+        return {
+            location: child_ids_by_location_id[location.id] for location in locations
+        }
+
     def _get_waiting_move_domain(self):
         """
         Returns a domain which selects waiting moves
@@ -162,49 +210,229 @@ class StockLocationOrderpoint(models.Model):
             ("procure_method", "=", "make_to_stock"),
         ]
         location_domains = []
-        for orderpoint in self:
+        # Orderpoints sharing a location give the same branch
+        for location_ids in self._get_child_location_ids_by_location().values():
             location_domains.append(
                 [
-                    ("location_id", "child_of", orderpoint.location_id.ids),
+                    ("location_id", "in", location_ids),
                     "!",
-                    ("location_dest_id", "child_of", orderpoint.location_id.ids),
+                    ("location_dest_id", "in", location_ids),
                 ]
             )
         if location_domains:
             domain = expression.AND([domain, expression.OR(location_domains)])
         return domain
 
+    def _get_waiting_move_source_domain(self, child_location_ids_by_location):
+        """
+        Returns a domain which selects the waiting moves
+        by their source location only
+
+        Unlike _get_waiting_move_domain, the moves staying inside the location
+        of an orderpoint are selected as well, the caller has to filter them out
+
+        :param child_location_ids_by_location: result of
+            _get_child_location_ids_by_location
+        """
+        location_ids = set()
+        for child_location_ids in child_location_ids_by_location.values():
+            location_ids.update(child_location_ids)
+        return expression.AND(
+            [
+                self.browse()._get_waiting_move_domain(),
+                [("location_id", "in", list(location_ids))],
+            ]
+        )
+
     def _find_potential_moves_to_replenish_by_location(self, products=False):
         """Return a dictionary of products per location that potentially require a replenishment
         based on the fact there are moves not reserved for those products.
         This reduces the list of products for which the quantity will be computed"""
-        domain = self._get_waiting_move_domain()
-        if products:
-            domain = expression.AND([domain, [("product_id", "in", products.ids)]])
-        moves_grouped = self.env["stock.move"].read_group(
-            domain,
-            ["ids:array_agg(id)", "location_id"],
-            "location_id",
+        if not self:
+            return {}
+        child_location_ids_by_location = self._get_child_location_ids_by_location()
+        domain = self._get_waiting_move_source_domain(child_location_ids_by_location)
+        # The children of the orderpoint locations containing each location
+        child_location_ids_by_child_id = defaultdict(list)
+        for child_location_ids in child_location_ids_by_location.values():
+            child_location_ids = set(child_location_ids)
+            for child_id in child_location_ids:
+                child_location_ids_by_child_id[child_id].append(child_location_ids)
+
+        def leaves_orderpoint_location(location_id, location_dest_id):
+            return any(
+                location_dest_id not in child_location_ids
+                for child_location_ids in child_location_ids_by_child_id[location_id]
+            )
+
+        move_ids_by_location = defaultdict(list)
+        if products and len(products) == 1:
+            # Usual case of the auto replenishment, a plain search
+            # is lighter than grouping the moves
+            waiting_moves = self.env["stock.move"].search(
+                expression.AND([domain, [("product_id", "=", products.id)]])
+            )
+            for move in waiting_moves:
+                if leaves_orderpoint_location(
+                    move.location_id.id, move.location_dest_id.id
+                ):
+                    move_ids_by_location[move.location_id.id].append(move.id)
+        else:
+            if products:
+                domain = expression.AND([domain, [("product_id", "in", products.ids)]])
+            moves_grouped = self.env["stock.move"].read_group(
+                domain,
+                ["ids:array_agg(id)", "location_id", "location_dest_id"],
+                ["location_id", "location_dest_id"],
+                lazy=False,
+            )
+            for res in moves_grouped:
+                location_id = res["location_id"][0]
+                if leaves_orderpoint_location(location_id, res["location_dest_id"][0]):
+                    move_ids_by_location[location_id] += res["ids"]
+        # Browse all the locations and moves at once to share their prefetching
+        locations = self.env["stock.location"].browse(list(move_ids_by_location))
+        moves = self.env["stock.move"].browse(
+            [
+                move_id
+                for move_ids in move_ids_by_location.values()
+                for move_id in move_ids
+            ]
         )
         return {
-            self.env["stock.location"]
-            .browse(res["location_id"][0]): self.env["stock.move"]
-            .browse(res["ids"])
-            for res in moves_grouped
+            location: moves.browse(move_ids_by_location[location.id]).with_prefetch(
+                moves._prefetch_ids
+            )
+            for location in locations
         }
 
     def _sort_orderpoints(self):
-        return self.sorted()
+        """Sorts the orderpoints in memory following _order"""
+        return self.sorted(
+            key=lambda orderpoint: (
+                -int(orderpoint.priority or "0"),
+                orderpoint.sequence,
+                orderpoint.id,
+            )
+        )
 
     @api.model
     def _compute_quantities_dict(self, locations, products):
+        """Returns the quantities of the given products per location
+
+        As for product._product_available with a location in the context,
+        the quantities of a location include the ones of its children.
+        The quants and the moves of all the locations are aggregated
+        by a single query.
+
+        :return: dict {(location id, product id): LocationQuantities}
+        """
         qties = {}
-        for location in locations:
-            qties_on_location = qties.setdefault(location, {})
-            products = products.with_context(location=location.id)
-            for product_id, qties_dict in products._product_available().items():
-                product = products.browse(product_id)
-                qties_on_location[product] = qties_dict
+        if not locations or not products:
+            return qties
+        self.env["stock.location"].flush(["parent_path"])
+        self.env["stock.quant"].flush(
+            ["location_id", "product_id", "quantity", "reserved_quantity"]
+        )
+        self.env["stock.move"].flush(
+            ["location_id", "location_dest_id", "product_id", "product_qty", "state"]
+        )
+        query = """
+            WITH location AS (
+                SELECT id, parent_path
+                FROM stock_location
+                WHERE id = ANY(%(location_ids)s)
+            ),
+            quant AS (
+                SELECT location.id AS location_id,
+                    quant.product_id,
+                    SUM(quant.quantity) AS qty,
+                    SUM(quant.reserved_quantity) AS reserved_qty
+                FROM stock_quant quant
+                JOIN stock_location quant_location
+                    ON quant_location.id = quant.location_id
+                JOIN location
+                    ON quant_location.parent_path LIKE location.parent_path || '%%'
+                WHERE quant.product_id = ANY(%(product_ids)s)
+                GROUP BY location.id, quant.product_id
+            ),
+            move AS (
+                SELECT move.product_id,
+                    move.product_qty,
+                    source.parent_path AS source_path,
+                    destination.parent_path AS destination_path
+                FROM stock_move move
+                JOIN stock_location source ON source.id = move.location_id
+                JOIN stock_location destination
+                    ON destination.id = move.location_dest_id
+                WHERE move.state IN (
+                        'waiting', 'confirmed', 'assigned', 'partially_available'
+                    )
+                    AND move.product_id = ANY(%(product_ids)s)
+            ),
+            incoming AS (
+                SELECT location.id AS location_id,
+                    move.product_id,
+                    SUM(move.product_qty) AS qty
+                FROM move
+                JOIN location
+                    ON move.destination_path LIKE location.parent_path || '%%'
+                    AND move.source_path NOT LIKE location.parent_path || '%%'
+                GROUP BY location.id, move.product_id
+            ),
+            outgoing AS (
+                SELECT location.id AS location_id,
+                    move.product_id,
+                    SUM(move.product_qty) AS qty
+                FROM move
+                JOIN location
+                    ON move.source_path LIKE location.parent_path || '%%'
+                    AND move.destination_path NOT LIKE location.parent_path || '%%'
+                GROUP BY location.id, move.product_id
+            )
+            SELECT location.id,
+                product.id,
+                COALESCE(quant.qty, 0),
+                COALESCE(quant.reserved_qty, 0),
+                COALESCE(incoming.qty, 0),
+                COALESCE(outgoing.qty, 0)
+            FROM location
+            CROSS JOIN UNNEST(%(product_ids)s) AS product(id)
+            LEFT JOIN quant
+                ON quant.location_id = location.id
+                AND quant.product_id = product.id
+            LEFT JOIN incoming
+                ON incoming.location_id = location.id
+                AND incoming.product_id = product.id
+            LEFT JOIN outgoing
+                ON outgoing.location_id = location.id
+                AND outgoing.product_id = product.id
+        """
+        self.env.cr.execute(
+            query, {"location_ids": locations.ids, "product_ids": products.ids}
+        )
+        roundings = {product.id: product.uom_id.rounding for product in products}
+        for (
+            location_id,
+            product_id,
+            qty_available,
+            reserved_qty,
+            incoming_qty,
+            outgoing_qty,
+        ) in self.env.cr.fetchall():
+            rounding = roundings[product_id]
+            incoming = float_round(incoming_qty, precision_rounding=rounding)
+            outgoing = float_round(outgoing_qty, precision_rounding=rounding)
+            qties[location_id, product_id] = LocationQuantities(
+                virtual_available=float_round(
+                    qty_available + incoming - outgoing, precision_rounding=rounding
+                ),
+                incoming_qty=incoming,
+                outgoing_qty=outgoing,
+                free_qty=float_round(
+                    qty_available - reserved_qty, precision_rounding=rounding
+                ),
+            )
         return qties
 
     def _get_qty_to_replenish(
@@ -228,35 +456,32 @@ class StockLocationOrderpoint(models.Model):
         if not self.location_src_id:
             return 0
 
-        qties_on_dest = qties_on_locations[self.location_id][product]
-        virtual_available_on_dest = qties_on_dest["virtual_available"]
-        if (
-            float_compare(
-                virtual_available_on_dest, 0, precision_rounding=product.uom_id.rounding
-            )
-            >= 0
-        ):
+        # Comparing to half of the rounding gives the same result as
+        # float_compare to 0 without rounding the quantities on each call
+        half_rounding = product.uom_id.rounding / 2
+        virtual_available_on_dest = qties_on_locations[
+            self.location_id.id, product.id
+        ].virtual_available
+        if virtual_available_on_dest > -half_rounding:
             return 0
 
         virtual_available_on_dest = abs(virtual_available_on_dest)
-        qties_on_src = qties_on_locations[self.location_src_id][product]
+        qties_on_src = qties_on_locations[self.location_src_id.id, product.id]
         virtual_available_on_src = (
-            qties_on_src["virtual_available"] - qties_on_src["incoming_qty"]
+            qties_on_src.virtual_available - qties_on_src.incoming_qty
         )
-        if (
-            float_compare(
-                virtual_available_on_src,
-                0,
-                precision_rounding=product.uom_id.rounding,
-            )
-            <= 0
-        ):
+        if virtual_available_on_src < half_rounding:
             return 0
 
         qty_to_replenish = virtual_available_on_dest - qty_already_replenished
         return min(qty_to_replenish, virtual_available_on_src)
 
     def _get_qties_to_replenish(self, moves_by_location):
+        """
+        Yields (orderpoint, product, qty) for each quantity to replenish,
+        the quantities yielded for a location are taken into account
+        by the next orderpoints of the same location
+        """
         products = set()
         for moves in moves_by_location.values():
             products.update(moves.product_id.ids)
@@ -264,47 +489,48 @@ class StockLocationOrderpoint(models.Model):
             (self.location_id | self.location_src_id),
             self.env["product.product"].browse(products),
         )
-        qties_replenished = defaultdict(lambda: defaultdict(lambda: 0))
-        qties_to_replenish = defaultdict(list)
+        qties_replenished = Counter()
         for orderpoint in self:
             if orderpoint.location_id not in moves_by_location:
                 continue
 
             for product in moves_by_location[orderpoint.location_id].product_id:
-                qties_replenished_for_location = qties_replenished[
-                    orderpoint.location_id
-                ]
+                key = (orderpoint.location_id.id, product.id)
                 qty_to_replenish = orderpoint._get_qty_to_replenish(
                     product,
                     qties_on_locations,
-                    qties_replenished_for_location[product],
+                    qties_replenished[key],
                 )
-                if (
-                    float_compare(
-                        qty_to_replenish, 0, precision_rounding=product.uom_id.rounding
-                    )
-                    > 0
-                ):
-                    qties_to_replenish[orderpoint].append((product, qty_to_replenish))
-                    qties_replenished_for_location[product] += qty_to_replenish
-        return qties_to_replenish
+                if qty_to_replenish >= product.uom_id.rounding / 2:
+                    qties_replenished[key] += qty_to_replenish
+                    yield orderpoint, product, qty_to_replenish
 
     def __prepare_procurements(self, moves_by_location):
-        qties_to_replenish_by_orderpoint = self._get_qties_to_replenish(
-            moves_by_location
-        )
         procurements = []
-        for orderpoint, qties_to_replenish in qties_to_replenish_by_orderpoint.items():
-            proc_vals = orderpoint._prepare_procurement_values()
-            for product, qty in qties_to_replenish:
-                date_planned = moves_by_location[
-                    orderpoint.location_id
-                ]._get_location_orderpoint_replenishment_date(product)
-                procurements.append(
-                    orderpoint._prepare_procurement(
-                        product, qty, date_planned, proc_vals
-                    )
+        warehouses = None
+        procurement_values = {}
+        dates_by_location = {}
+        for orderpoint, product, qty in self._get_qties_to_replenish(moves_by_location):
+            location = orderpoint.location_id
+            if orderpoint not in procurement_values:
+                if warehouses is None:
+                    # Search the warehouses once for all the locations,
+                    # only when there is something to replenish
+                    warehouses = self.location_id._get_closest_warehouse()
+                warehouse = warehouses[location.id] or self.env["stock.warehouse"]
+                procurement_values[orderpoint] = orderpoint._prepare_procurement_values(
+                    warehouse=warehouse
+                )
+            if location not in dates_by_location:
+                dates_by_location[location] = moves_by_location[
+                    location
+                ]._get_location_orderpoint_replenishment_dates()
+            date_planned = dates_by_location[location][product.id]
+            procurements.append(
+                orderpoint._prepare_procurement(
+                    product, qty, date_planned, procurement_values[orderpoint]
                 )
+            )
         return procurements
 
     def _prepare_procurements(self, products=False):
@@ -338,7 +564,8 @@ class StockLocationOrderpoint(models.Model):
         moves_to_assign = self.env["stock.move"].search(
             domain, order="priority desc, date asc, id asc"
         )
-        for moves_chunk in split_every(100, moves_to_assign.ids):
+        # Each chunk is browsed on its own so that its moves are prefetched together
+        for moves_chunk in split_every(500, moves_to_assign.ids):
             self.env["stock.move"].browse(moves_chunk)._action_assign()
 
     def _after_replenishment(self):
@@ -379,6 +606,31 @@ class StockLocationOrderpoint(models.Model):
         domain = self._prepare_orderpoint_domain(trigger, locations, location_field)
         return self.search(domain)
 
+    def _get_location_parent_paths(self, location_field):
+        """
+        Returns the sorted parent paths of the orderpoints' locations,
+        without the paths already included in another one
+        so that only the closest lower path can be a parent of a location
+
+        :param location_field: should be location_id or location_src_id
+        """
+        parent_paths = []
+        for path in sorted(set(getattr(self, location_field).mapped("parent_path"))):
+            if not parent_paths or not path.startswith(parent_paths[-1]):
+                parent_paths.append(path)
+        return parent_paths
+
+    @api.model
+    def _is_path_child_of(self, path, parent_paths):
+        """
+        Checks if the given path is included in one of the parent paths
+
+        :param path: parent_path of a stock.location
+        :param parent_paths: list returned by _get_location_parent_paths
+        """
+        index = bisect_right(parent_paths, path)
+        return bool(index) and path.startswith(parent_paths[index - 1])
+
     def _is_location_parent_of(self, location, location_field):
         """
         Checks if one location of the given orderpoints
@@ -392,6 +644,23 @@ class StockLocationOrderpoint(models.Model):
             if location.parent_path.startswith(parent_location.parent_path):
                 return True
 
+    def _filter_child_locations(self, locations, location_field):
+        """
+        Returns the given locations having one location
+        of the given orderpoints as parent
+
+        Batch version of _is_location_parent_of, the parent paths
+        of the orderpoints are sorted once for all the given locations
+
+        :param locations: browse record list of stock.location
+        :param location_field: should be location_id or location_src_id
+            orderpoints location field to check against
+        """
+        parent_paths = self._get_location_parent_paths(location_field)
+        return locations.filtered(
+            lambda location: self._is_path_child_of(location.parent_path, parent_paths)
+        )
+
     @api.model
     def run_auto_replenishment(self, products, locations, location_field=False):
         """
@@ -408,6 +677,35 @@ class StockLocationOrderpoint(models.Model):
         self.run_replenishment(products)
 
     @api.model
-    def run_cron_replenishment(self, location_ids=False):
+    def run_cron_replenishment(self, location_ids=False, use_new_cursor=False):
+        """
+        Run the replenishment of the scheduled orderpoints
+
+        :param location_ids: list of stock.location ids to replenish
+        :param use_new_cursor: replenish the locations by chunks,
+            each chunk being committed in its own transaction
+        """
         self = self._get_orderpoints("cron", location_ids)
-        self.run_replenishment()
+        if not use_new_cursor:
+            self.run_replenishment()
+            return
+        orderpoint_ids_by_location = defaultdict(list)
+        for orderpoint in self:
+            orderpoint_ids_by_location[orderpoint.location_id.id].append(orderpoint.id)
+        for location_ids_chunk in split_every(200, list(orderpoint_ids_by_location)):
+            orderpoint_ids = [
+                orderpoint_id
+                for location_id in location_ids_chunk
+                for orderpoint_id in orderpoint_ids_by_location[location_id]
+            ]
+            # The cursor is committed when leaving the block
+            with self.pool.cursor() as cr:
+                orderpoints = self.with_env(self.env(cr=cr)).browse(orderpoint_ids)
+                try:
+                    orderpoints.run_replenishment()
+                except ProcurementException:
+                    cr.rollback()
+                    _logger.exception(
+                        "Unable to replenish the locations of the orderpoints %s",
+                        orderpoint_ids,
+                    )
@@ -3,7 +3,7 @@
 from collections import defaultdict
 
 from odoo import _, fields, models
-from odoo.tools import ormcache
+from odoo.tools.sql import index_exists
 
 from odoo.addons.queue_job.job import identity_exact
 
@@ -12,14 +12,42 @@ class StockMove(models.Model):
     _inherit = "stock.move"
 
     location_orderpoint_id = fields.Many2one(
-        "stock.location.orderpoint", "Stock location orderpoint", index=True
+        "stock.location.orderpoint", "Stock location orderpoint"
     )
 
-    @ormcache("self", "product")
-    def _get_location_orderpoint_replenishment_date(self, product):
-        return min(
-            self.filtered(lambda move: move.product_id == product).mapped("date")
-        )
+    def init(self):
+        super().init()
+        cr = self.env.cr
+        # Most of the moves are not created by a location orderpoint,
+        # partial indexes are much smaller than an index on the whole table
+        if not index_exists(cr, "stock_move_location_orderpoint_id_not_null_index"):
+            cr.execute(
+                """
+                CREATE INDEX stock_move_location_orderpoint_id_not_null_index
+                ON stock_move (location_orderpoint_id)
+                WHERE location_orderpoint_id IS NOT NULL
+                """
+            )
+        # Used to select the moves to assign after a replenishment
+        if not index_exists(cr, "stock_move_location_orderpoint_id_to_assign_index"):
+            cr.execute(
+                """
+                CREATE INDEX stock_move_location_orderpoint_id_to_assign_index
+                ON stock_move (location_orderpoint_id, state)
+                WHERE location_orderpoint_id IS NOT NULL
+                    AND procure_method = 'make_to_stock'
+                    AND state IN ('confirmed', 'partially_available')
+                """
+            )
+
+    def _get_location_orderpoint_replenishment_dates(self):
+        """Returns the earliest date of the moves per product id"""
+        dates = {}
+        for move in self:
+            product_id = move.product_id.id
+            if product_id not in dates or move.date < dates[product_id]:
+                dates[product_id] = move.date
+        return dates
 
     def _prepare_auto_replenishment_for_waiting_moves(self):
         self._prepare_auto_replenishment(
@@ -55,10 +83,11 @@ class StockMove(models.Model):
         orderpoints = self.env["stock.location.orderpoint"]._get_orderpoints(
             "auto", list(location_ids), location_field
         )
-        for location, products in locations_products.items():
-            if not orderpoints._is_location_parent_of(location, location_field):
-                continue
-            for product in product_obj.browse(products):
+        locations = orderpoints._filter_child_locations(
+            self.env["stock.location"].union(*locations_products), location_field
+        )
+        for location in locations:
+            for product in product_obj.browse(locations_products[location]):
                 self._enqueue_auto_replenishment(
                     location, product, location_field
                 ).delay()
@@ -1,6 +1,8 @@
 # Copyright 2023 Michael Tietz (MT Software) <mtietz@mt-software.de>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
+from unittest import mock
+
 from psycopg2 import IntegrityError
 
 from odoo.exceptions import ValidationError
@@ -8,6 +10,7 @@ from odoo.tools import mute_logger
 
 from odoo.addons.queue_job.job import identity_exact
 from odoo.addons.queue_job.tests.common import trap_jobs
+from odoo.addons.stock.models.stock_rule import ProcurementException
 
 from .common import TestLocationOrderpointCommon
 
@@ -86,6 +89,55 @@ class TestLocationOrderpoint(TestLocationOrderpointCommon):
         replenish_move = self._get_replenishment_move(orderpoint)
         self._check_replenishment_move(replenish_move, 12, orderpoint)
 
+    def test_cron_replenishment_new_cursor(self):
+        # The new cursors of the chunks are test cursors on the test transaction
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="cron"
+        )
+        self._create_outgoing_move(12)
+        self._create_quants(self.product, location_src, 12)
+
+        self.product.invalidate_cache()
+        orderpoint.run_cron_replenishment(use_new_cursor=True)
+
+        orderpoint.invalidate_cache()
+        replenish_move = self._get_replenishment_move(orderpoint)
+        self._check_replenishment_move(replenish_move, 12, orderpoint)
+
+    def test_cron_replenishment_new_cursor_exception(self):
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="cron"
+        )
+        self._create_outgoing_move(12)
+        self._create_quants(self.product, location_src, 12)
+
+        orderpoint_model = type(orderpoint)
+        run_replenishment = orderpoint_model.run_replenishment
+
+        def run_replenishment_and_fail(orderpoints, *args, **kwargs):
+            run_replenishment(orderpoints, *args, **kwargs)
+            raise ProcurementException([])
+
+        self.product.invalidate_cache()
+        with mock.patch.object(
+            orderpoint_model,
+            "run_replenishment",
+            autospec=True,
+            side_effect=run_replenishment_and_fail,
+        ), self.assertLogs(
+            "odoo.addons.stock_location_orderpoint.models.stock_location_orderpoint",
+            level="ERROR",
+        ):
+            orderpoint.run_cron_replenishment(use_new_cursor=True)
+
+        # The replenishment of the failing chunk is rolled back
+        orderpoint.invalidate_cache()
+        self.assertFalse(self._get_replenishment_move(orderpoint))
+
     def test_auto_replenishment(self):
         job_func = self.env["stock.location.orderpoint"].run_auto_replenishment
         move_qty = 12
@@ -191,3 +243,95 @@ class TestLocationOrderpoint(TestLocationOrderpointCommon):
         self.assertEqual(1, self.location_dest.location_orderpoint_count)
         _, _ = self._create_orderpoint_complete("Stock3", trigger="cron")
         self.assertEqual(2, self.location_dest.location_orderpoint_count)
+
+    def test_compute_quantities_dict(self):
+        location = self._create_location("Stock2")
+        sublocation = self.env["stock.location"].create(
+            {"name": "Stock2.1", "location_id": location.id}
+        )
+        self._create_quants(self.product, sublocation, 10)
+        self._create_move("Internal", 4, sublocation, self.location_dest)
+        # A move inside the location is neither incoming nor outgoing
+        self._create_move("Internal", 2, sublocation, location)
+
+        qties = self.env["stock.location.orderpoint"]._compute_quantities_dict(
+            location | self.location_dest, self.product
+        )
+        qties_on_location = qties[location.id, self.product.id]
+        self.assertEqual(qties_on_location.virtual_available, 6)
+        self.assertEqual(qties_on_location.incoming_qty, 0)
+        self.assertEqual(qties_on_location.outgoing_qty, 4)
+        self.assertEqual(qties_on_location.free_qty, 10)
+        qties_on_dest = qties[self.location_dest.id, self.product.id]
+        self.assertEqual(qties_on_dest.virtual_available, 4)
+        self.assertEqual(qties_on_dest.incoming_qty, 4)
+
+    def test_filter_child_locations(self):
+        orderpoint, location_src = self._create_orderpoint_complete("Stock2")
+        sublocation = self.env["stock.location"].create(
+            {"name": "Shelf", "location_id": self.location_dest.id}
+        )
+        other_location = self._create_location("Stock3")
+        locations = self.location_dest | sublocation | location_src | other_location
+        self.assertEqual(
+            orderpoint._filter_child_locations(locations, "location_id"),
+            self.location_dest | sublocation,
+        )
+        self.assertEqual(
+            orderpoint._filter_child_locations(locations, "location_src_id"),
+            location_src,
+        )
+        self.assertTrue(orderpoint._is_location_parent_of(sublocation, "location_id"))
+        self.assertFalse(
+            orderpoint._is_location_parent_of(other_location, "location_id")
+        )
+        # Only the closest lower parent path has to be checked
+        self.assertTrue(orderpoint._is_path_child_of("1/3/", ["1/", "2/"]))
+        self.assertFalse(orderpoint._is_path_child_of("1/3/", ["1/2/", "1/4/"]))
+
+    def test_child_location_ids_by_location(self):
+        orderpoint, _ = self._create_orderpoint_complete("Stock2")
+        sublocation = self.env["stock.location"].create(
+            {"name": "Shelf", "location_id": self.location_dest.id}
+        )
+        orderpoints = orderpoint | self._create_orderpoint(location_id=sublocation)
+        child_ids_by_location = orderpoints._get_child_location_ids_by_location()
+        self.assertEqual(len(child_ids_by_location), 2)
+        self.assertIn(sublocation.id, child_ids_by_location[self.location_dest])
+        self.assertIn(self.location_dest.id, child_ids_by_location[self.location_dest])
+        self.assertEqual(child_ids_by_location[sublocation], [sublocation.id])
+        # Archived children are included as well
+        archived_location = self.env["stock.location"].create(
+            {"name": "Archived", "location_id": self.location_dest.id, "active": False}
+        )
+        child_ids_by_location = orderpoints._get_child_location_ids_by_location()
+        self.assertIn(archived_location.id, child_ids_by_location[self.location_dest])
+        # A moved sublocation is no longer a child of its former parent
+        sublocation.location_id = self._create_location("Stock3")
+        child_ids_by_location = orderpoints._get_child_location_ids_by_location()
+        self.assertNotIn(sublocation.id, child_ids_by_location[self.location_dest])
+        self.assertEqual(child_ids_by_location[sublocation], [sublocation.id])
+
+    def test_internal_move_no_replenishment(self):
+        orderpoint, location_src = self._create_orderpoint_complete(
+            "Stock2", trigger="manual"
+        )
+        self._create_quants(self.product, location_src, 12)
+        sublocation = self.env["stock.location"].create(
+            {"name": "Shelf", "location_id": self.location_dest.id}
+        )
+        # A move inside the orderpoint location does not need a replenishment
+        self._create_move("Internal", 5, sublocation, self.location_dest)
+        self.assertFalse(orderpoint._find_potential_moves_to_replenish_by_location())
+        self._run_replenishment(orderpoint)
+        self.assertFalse(self._get_replenishment_move(orderpoint))
+
+        # A move leaving the orderpoint location does
+        move = self._create_outgoing_move(3)
+        self.assertEqual(
+            orderpoint._find_potential_moves_to_replenish_by_location(),
+            {self.location_dest: move},
+        )
+        self._run_replenishment(orderpoint)
+        replenish_move = self._get_replenishment_move(orderpoint)
+        self._check_replenishment_move(replenish_move, 3, orderpoint)
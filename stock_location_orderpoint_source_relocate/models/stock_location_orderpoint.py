@@ -15,7 +15,7 @@ class StockLocationOrderpoint(models.Model):
         # Those moves are not considered by the standard virtual available
         # stock.
         Move = self.env["stock.move"].with_context(active_test=False)
-        for location, location_dict in qties.items():
+        for location in locations:
             products = products.with_context(location=location.id)
             _, _, domain_move_out_loc = products._get_domain_locations()
             domain_move_out_loc_todo = [
@@ -25,19 +25,23 @@ class StockLocationOrderpoint(models.Model):
                     ("waiting", "confirmed", "assigned", "partially_available"),
                 )
             ] + domain_move_out_loc
-            for product, qty in location_dict.items():
+            for product in products:
+                key = (location.id, product.id)
+                qty = qties[key]
                 moves = Move.search(
                     domain_move_out_loc_todo + [("product_id", "=", product.id)],
                     order="id",
                 )
                 rounding = product.uom_id.rounding
                 unreserved_availability = float_round(
-                    qty["outgoing_qty"] - sum(m.reserved_availability for m in moves),
+                    qty.outgoing_qty - sum(m.reserved_availability for m in moves),
                     precision_rounding=rounding,
                 )
-                qty["virtual_available"] = float_round(
-                    qty["free_qty"] + qty["incoming_qty"] - unreserved_availability,
-                    precision_rounding=rounding,
+                qties[key] = qty._replace(
+                    virtual_available=float_round(
+                        qty.free_qty + qty.incoming_qty - unreserved_availability,
+                        precision_rounding=rounding,
+                    )
                 )
 
         return qties